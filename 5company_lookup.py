@@ -14,9 +14,28 @@ Key changes vs. the GICS edition:
 - Enforces AFI rounding and AFI band (High/Mid/Low) post-parse.
 - Removes the GICS mapping requirement (kept doc structure simple).
 
+Run modes (--mode):
+  batch (default) : submit all companies as one OpenAI Batch API job
+                    (24h completion window, ~50% cheaper, no rate limits),
+                    then index the downloaded results.
+  sync            : concurrent real-time chat completions; use for small
+                    runs where you want results immediately.
+
 Environment variables expected (no insecure defaults):
   OPENAI_API_KEY        : your API key (required)
   OPENAI_MODEL          : default "gpt-4o" (optional)
+  OPENAI_CONCURRENCY    : max in-flight OpenAI requests per process (default 20)
+  WORKERS               : sync-mode worker processes (default: CPU count)
+  OPENAI_RPM            : requests/minute ceiling for self-pacing (default 500)
+  OPENAI_TPM            : tokens/minute ceiling for self-pacing (default 200000)
+  BATCH_POLL_SECONDS    : batch status poll interval in seconds (default 60)
+  CACHE_DB_PATH         : sqlite response cache path (default "./cache.db")
+  SEMANTIC_CACHE_THRESHOLD : cosine cutoff for semantic cache hits (default 0.95)
+  OS_BULK_MAX_BYTES     : flush when buffered bulk body reaches this (default 10 MB)
+  OS_BULK_MAX_DOCS      : flush when this many docs are buffered (default 500)
+  OS_BULK_ROUTING       : on/off; route each batch to one shard (default off)
+  OS_TUNE_INDEX         : on/off; relax refresh/translog during ingest (default on)
+  ABOUT_MAX_CHARS       : max chars of cleaned about text in prompts (default 1500)
   OS_URL                : OpenSearch bulk URL, e.g. "https://host:9200/index/_bulk" (required)
   OS_USERNAME           : OpenSearch user (required)
   OS_PASSWORD           : OpenSearch password (required)
@@ -26,11 +45,27 @@ Environment variables expected (no insecure defaults):
   LOG_DIR               : Where to write logs (default: "./logs" if unwritable otherwise)
 """
 
-import os, json, re
+import argparse
+import asyncio
+import atexit
+import gzip
+import hashlib
+import itertools
+import multiprocessing as mp
+import os, re, secrets, sqlite3, sys, time
 from datetime import datetime
+from typing import Iterable, Iterator
+import faiss
+import ijson
+import numpy as np
+import orjson
 import openai, requests
-from tenacity import retry, wait_exponential, stop_after_attempt
-from tqdm import tqdm
+import tiktoken
+from requests.adapters import HTTPAdapter
+from selectolax.parser import HTMLParser
+from urllib3.util.retry import Retry
+from aiolimiter import AsyncLimiter
+from tqdm.asyncio import tqdm_asyncio
 
 # ─────────────── CONFIG ───────────────
 def getenv_required(name: str) -> str:
@@ -51,6 +86,33 @@ def getenv_required(name: str) -> str:
 # Select via env var OPENAI_MODEL if you want to override the default.
 OPENAI_MODEL     = os.getenv("OPENAI_MODEL", "gpt-4o")
 
+# Number of OpenAI requests kept in flight concurrently. The workload is
+# network-bound (~1–3 s per call), so wall time scales almost linearly with
+# this value until the account's RPM/TPM ceiling is reached. 10–50 is a sane
+# range; raise it only if you are not seeing 429s.
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "20"))
+
+# Sync-mode worker process count. Async I/O hides network latency, but the
+# per-response CPU work (JSON parse/serialize, normalization) still runs
+# under one GIL; sharding across processes scales that part linearly.
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+
+# Account rate-limit ceilings (requests/min and tokens/min). Set these to the
+# values shown on your account's limits page; the defaults are deliberately
+# conservative so a fresh key does not trip 429s out of the box.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+
+# How often to poll a submitted batch for completion (seconds).
+BATCH_POLL_SECONDS = int(os.getenv("BATCH_POLL_SECONDS", "60"))
+
+# Response cache: exact prompt hashes plus a semantic nearest-neighbor tier,
+# persisted so reruns skip companies that were already answered.
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "./cache.db")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+
 OS_URL           = getenv_required("OS_URL")
 OS_USERNAME      = getenv_required("OS_USERNAME")
 OS_PASSWORD      = getenv_required("OS_PASSWORD")
@@ -65,45 +127,82 @@ LOG_DIR = os.getenv("LOG_DIR", "/apps/chamber")
 if not os.access(LOG_DIR, os.W_OK):
     LOG_DIR = "./logs"
 os.makedirs(LOG_DIR, exist_ok=True)
-logfile = os.path.join(LOG_DIR, f"run_{datetime.now():%Y%m%d_%H%M%S}.log")
+# Worker processes inherit the parent's logfile via this env var so all
+# shards append to one file (O_APPEND writes below make that safe).
+logfile = os.getenv("CHAMBER_LOGFILE") or \
+    os.path.join(LOG_DIR, f"run_{datetime.now():%Y%m%d_%H%M%S}.log")
+
+# One fd opened with O_APPEND for the whole run: a single os.write per line,
+# no logging-framework overhead, and appends up to PIPE_BUF bytes are atomic,
+# so concurrent tasks (or worker processes sharing the file) never interleave
+# lines and need no lock.
+LOGFD = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+atexit.register(os.close, LOGFD)
 
 def log(msg, also_print=True):
-    ts = datetime.now().isoformat(timespec="seconds")
-    with open(logfile, "a", encoding="utf-8") as f:
-        f.write(f"{ts} {msg}\n")
+    line = f"{datetime.now().isoformat(timespec='seconds')} {msg}\n"
+    os.write(LOGFD, line.encode("utf-8"))
     if also_print:
-        print(f"{ts} {msg}")
+        sys.stdout.write(line)
 
 log("===== Script Started (Prompt01 mode) =====")
 
 # ─────────────── UTILITIES ───────────────
+# Compiled once: both patterns run on every company (or every prompt load),
+# and a single sub() pass beats one template.replace() per company key.
+PLACEHOLDER_RE  = re.compile(r"\{([a-zA-Z0-9_]+)\}")
+PROMPT_SPLIT_RE = re.compile(r"(?is)SYSTEM:\s*(.*?)\n\s*USER:\s*(.*)\Z")
+WHITESPACE_RE   = re.compile(r"\s+")
+
+# Raw about_html is mostly markup and boilerplate; 1500 chars of clean text
+# is plenty for classification and cuts prompt tokens several-fold.
+ABOUT_MAX_CHARS = int(os.getenv("ABOUT_MAX_CHARS", "1500"))
+
+def clean_about(html: str, max_chars: int = ABOUT_MAX_CHARS) -> str:
+    """Strip HTML to plain text, collapse whitespace, and truncate."""
+    text = HTMLParser(html or "").text(separator=" ", strip=True)
+    return WHITESPACE_RE.sub(" ", text).strip()[:max_chars]
+
 def slurp(path: str) -> str:
     with open(path, encoding="utf-8") as fh:
         return fh.read()
 
 def stringify(x):
-    """Convert elements to printable strings suitable for prompt injection."""
-    if isinstance(x, dict):
+    """Convert elements to printable strings suitable for prompt injection.
+
+    Exact type() checks, ordered by frequency: most field values are already
+    strings, so they short-circuit before any container handling. Input comes
+    from parsed JSON, so subclasses never occur and isinstance is not needed.
+    """
+    t = type(x)
+    if t is str:
+        return x
+    if t is dict:
         # prefer human-friendly keys if present
         for key in ("url", "platform", "name", "value"):
-            if key in x and x[key]:
-                return str(x[key])
-        return json.dumps(x, ensure_ascii=False)
-    if isinstance(x, list):
+            v = x.get(key)
+            if v:
+                return v if type(v) is str else str(v)
+        return orjson.dumps(x).decode()
+    if t is list:
         return ", ".join(stringify(i) for i in x)
     if x is None:
         return ""
     return str(x)
 
-def render_placeholders(template: str, company: dict) -> str:
-    """Replace {field} placeholders with company values; remove any leftovers."""
-    out = template
-    # Perform simple {key} replacement using string keys in the company dict
-    for k, v in company.items():
-        out = out.replace("{" + k + "}", stringify(v))
-    # Remove any unreplaced placeholders
-    out = re.sub(r"\{[a-zA-Z0-9_]+\}", "", out)
-    return out
+def compile_template(template: str) -> tuple[list[str], list[str]]:
+    """Split a template into literal fragments and the field names between them.
+
+    Done once at load; per-company rendering is then just a join of the
+    fragments interleaved with field values — no regex work per call.
+    """
+    parts, fields, last = [], [], 0
+    for m in PLACEHOLDER_RE.finditer(template):
+        parts.append(template[last:m.start()])
+        fields.append(m.group(1))
+        last = m.end()
+    parts.append(template[last:])
+    return parts, fields
 
 def unify_company_record(rec: dict) -> dict:
     """Normalize differing input schemas into the expected fields.
@@ -144,10 +243,10 @@ def unify_company_record(rec: dict) -> dict:
         links = out.get("social") or out.get("socials") or []
         out["social_links"] = links if isinstance(links, list) else ([links] if links else [])
 
-    # about_html: fall back to 'about' or 'description'
-    if not out.get("about_html"):
-        about = out.get("about") or out.get("description") or ""
-        out["about_html"] = about
+    # about_html: fall back to 'about' or 'description', then strip markup
+    # and truncate so the prompt carries text, not multi-KB of tags
+    about = out.get("about_html") or out.get("about") or out.get("description") or ""
+    out["about_html"] = clean_about(stringify(about))
 
     return out
 
@@ -157,7 +256,7 @@ def split_prompt01(prompt_text: str) -> tuple[str, str]:
     If markers are missing, treat entire text as USER content.
     """
     # Use case-insensitive markers "SYSTEM:" and "USER:"
-    m = re.search(r"(?is)SYSTEM:\s*(.*?)\n\s*USER:\s*(.*)\Z", prompt_text)
+    m = PROMPT_SPLIT_RE.search(prompt_text)
     if m:
         system_text = m.group(1).strip()
         user_text   = m.group(2).strip()
@@ -167,15 +266,20 @@ def split_prompt01(prompt_text: str) -> tuple[str, str]:
     return system_text, user_text
 
 # ─────────────── LOAD DATA ───────────────
-try:
-    companies = json.load(open(MEMBER_JSON_PATH, encoding="utf-8"))
-    if not isinstance(companies, list):
-        raise ValueError("member_index.json must be a list of company objects")
-    # Normalize records to a common schema so either file format works
-    companies = [unify_company_record(c) for c in companies]
-    log(f"Loaded {len(companies):,} companies from {MEMBER_JSON_PATH}")
-except Exception as e:
-    raise SystemExit(f"Cannot load companies: {e}")
+def iter_companies(path: str) -> Iterator[dict]:
+    """Stream company records one at a time instead of materializing the list.
+
+    Peak memory stays O(concurrency) regardless of input size. Records are
+    normalized to a common schema so either file format works.
+    """
+    with open(path, "rb") as fh:
+        for rec in ijson.items(fh, "item"):
+            yield unify_company_record(rec)
+
+def count_companies(path: str) -> int:
+    """One cheap streaming pass: validates the file and gives tqdm a total."""
+    with open(path, "rb") as fh:
+        return sum(1 for _ in ijson.items(fh, "item"))
 
 prompt01_text = slurp(PROMPT01_PATH)
 SYSTEM_TEXT, USER_TEMPLATE = split_prompt01(prompt01_text)
@@ -184,46 +288,245 @@ if SYSTEM_TEXT:
 else:
     log("Prompt01.txt has no explicit SYSTEM block; using single USER message")
 
+_USER_PARTS, _USER_FIELDS = compile_template(USER_TEMPLATE)
+
+def render_user_msg(company: dict) -> str:
+    """Render the USER template for one company; missing fields become ""."""
+    out = [_USER_PARTS[0]]
+    for field, part in zip(_USER_FIELDS, _USER_PARTS[1:]):
+        out.append(stringify(company.get(field, "")))
+        out.append(part)
+    return "".join(out)
+
 # ─────────────── OPENAI ───────────────
-openai.api_key = getenv_required("OPENAI_API_KEY")
+OPENAI_API_KEY = getenv_required("OPENAI_API_KEY")
 
-@retry(wait=wait_exponential(multiplier=2, min=2, max=20), stop=stop_after_attempt(3))
-def ask_openai(system_text: str, user_text: str, name: str) -> str:
-    log(f"→ OpenAI request for {name}")
+# Async client for the real-time path; retries are handled explicitly below so
+# the SDK's built-in retry loop is disabled to avoid doubling up sleeps. The
+# sync client drives the file/batch endpoints, which are not latency-critical.
+ACLIENT = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+CLIENT  = openai.OpenAI(api_key=OPENAI_API_KEY)
+
+def build_messages(system_text: str, user_text: str) -> list[dict]:
     messages = []
     if system_text:
         messages.append({"role": "system", "content": system_text})
     messages.append({"role": "user", "content": user_text})
+    return messages
 
-    r = openai.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-        response_format={"type": "json_object"},
-        temperature=0.2,
-        timeout=120,
-    )
-    return r.choices[0].message.content
+# ─────────────── RATE LIMITING ───────────────
+# Token buckets keep us *below* the account ceiling instead of absorbing 429s
+# with retry sleeps. RPM is one permit per request; TPM permits are estimated
+# from the rendered prompt via tiktoken plus a completion allowance.
+RPM_LIMITER = AsyncLimiter(OPENAI_RPM, 60)
+TPM_LIMITER = AsyncLimiter(OPENAI_TPM, 60)
+
+# Rough upper bound on completion tokens for a Prompt01 JSON object.
+COMPLETION_TOKEN_ALLOWANCE = 500
+
+try:
+    _ENCODER = tiktoken.encoding_for_model(OPENAI_MODEL)
+except KeyError:
+    _ENCODER = tiktoken.get_encoding("o200k_base")
+
+def estimate_tokens(system_text: str, user_text: str) -> int:
+    return len(_ENCODER.encode(system_text)) + len(_ENCODER.encode(user_text)) \
+        + COMPLETION_TOKEN_ALLOWANCE
+
+# When response headers say the server-side budget is exhausted, pause new
+# requests until the advertised reset instead of letting them 429.
+_RATE_PAUSE_UNTIL = 0.0
+
+_RESET_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+
+def _parse_reset(value: str) -> float:
+    """Parse OpenAI reset durations like '12ms', '1s', '6m30s' into seconds."""
+    total = 0.0
+    for amount, unit in _RESET_PART_RE.findall(value or ""):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+def _note_rate_headers(headers) -> None:
+    global _RATE_PAUSE_UNTIL
+    try:
+        remaining_req = int(headers.get("x-ratelimit-remaining-requests", 1))
+        remaining_tok = int(headers.get("x-ratelimit-remaining-tokens", 1))
+    except (TypeError, ValueError):
+        return
+    if remaining_req <= 0:
+        wait = _parse_reset(headers.get("x-ratelimit-reset-requests", ""))
+    elif remaining_tok <= COMPLETION_TOKEN_ALLOWANCE:
+        wait = _parse_reset(headers.get("x-ratelimit-reset-tokens", ""))
+    else:
+        return
+    if wait > 0:
+        _RATE_PAUSE_UNTIL = max(_RATE_PAUSE_UNTIL, time.monotonic() + wait)
+        log(f"Rate-limit budget exhausted; pausing new requests {wait:.1f}s")
+
+OPENAI_MAX_ATTEMPTS = 5
+
+async def ask_openai(system_text: str, user_text: str, name: str) -> str:
+    """Call the chat model, retrying only what is actually retryable.
+
+    429s sleep for max(Retry-After, exponential backoff) so server guidance
+    is honored; 5xx and connection errors back off exponentially. Everything
+    else (400 invalid request, auth, ...) raises immediately instead of
+    burning retry sleeps on a permanent failure.
+    """
+    log(f"→ OpenAI request for {name}")
+    messages = build_messages(system_text, user_text)
+
+    # TPM permits cannot exceed the bucket capacity; clamp oversized prompts.
+    tokens = min(estimate_tokens(system_text, user_text), OPENAI_TPM)
+
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        pause = _RATE_PAUSE_UNTIL - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        try:
+            async with RPM_LIMITER:
+                await TPM_LIMITER.acquire(tokens)
+                raw = await ACLIENT.chat.completions.with_raw_response.create(
+                    model=OPENAI_MODEL,
+                    messages=messages,
+                    response_format={"type": "json_object"},
+                    temperature=0.2,
+                    timeout=120,
+                )
+        except openai.RateLimitError as e:  # must precede APIStatusError
+            _note_rate_headers(e.response.headers)
+            if attempt == OPENAI_MAX_ATTEMPTS - 1:
+                raise
+            try:
+                retry_after = float(e.response.headers.get("retry-after", 0))
+            except (TypeError, ValueError):
+                retry_after = 0.0
+            wait = max(retry_after, 2.0 ** attempt)
+            log(f"429 for {name}; retrying in {wait:.1f}s")
+            await asyncio.sleep(wait)
+        except openai.APIStatusError as e:
+            if e.status_code < 500 or attempt == OPENAI_MAX_ATTEMPTS - 1:
+                raise
+            log(f"{e.status_code} for {name}; retrying in {2 ** attempt}s")
+            await asyncio.sleep(2 ** attempt)
+        except openai.APIConnectionError:
+            if attempt == OPENAI_MAX_ATTEMPTS - 1:
+                raise
+            log(f"Connection error for {name}; retrying in {2 ** attempt}s")
+            await asyncio.sleep(2 ** attempt)
+        else:
+            _note_rate_headers(raw.headers)
+            return raw.parse().choices[0].message.content
+
+# ─────────────── RESPONSE CACHE ───────────────
+# Two-tier cache for the sync path. Tier 1 is an exact SHA256 lookup on the
+# rendered user message (sub-millisecond sqlite hit). Tier 2 embeds the
+# message and searches a faiss inner-product index over prior prompts; a
+# cosine score above SEMANTIC_CACHE_THRESHOLD returns the cached response,
+# which handles near-duplicate companies (shared boilerplate, same industry
+# blurb) that hash differently. Both tiers persist in CACHE_DB_PATH.
+# timeout covers multi-process runs: workers share the file and sqlite
+# serializes writers, so a busy writer should wait instead of erroring.
+# check_same_thread=False lets flush() (run via asyncio.to_thread) mark
+# processed keys; CPython's sqlite is built serialized, so sharing the
+# connection across threads is safe.
+_CACHE = sqlite3.connect(CACHE_DB_PATH, timeout=30, check_same_thread=False)
+_CACHE.executescript("""
+    CREATE TABLE IF NOT EXISTS exact_cache (
+        prompt_hash TEXT PRIMARY KEY,
+        response    TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS semantic_cache (
+        id        INTEGER PRIMARY KEY AUTOINCREMENT,
+        embedding BLOB NOT NULL,
+        response  TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS processed (
+        content_key TEXT PRIMARY KEY,
+        doc_id      TEXT NOT NULL
+    );
+""")
+
+# Dedup / resume ledger: a canonical hash of the normalized facts identifies
+# a company across source files (merged directories often repeat entries) and
+# across runs, so duplicates and already-indexed records never reach the LLM.
+_DEDUP_FIELDS = ("company_name", "primary_address", "website_url", "about_html")
+
+def content_key(company: dict) -> str:
+    facts = {k: company.get(k) for k in _DEDUP_FIELDS}
+    return hashlib.blake2b(
+        orjson.dumps(facts, option=orjson.OPT_SORT_KEYS), digest_size=16
+    ).hexdigest()
+
+def already_processed(key: str) -> bool:
+    return _CACHE.execute(
+        "SELECT 1 FROM processed WHERE content_key = ?", (key,)).fetchone() is not None
+
+def mark_processed(key: str, doc_id: str):
+    _CACHE.execute(
+        "INSERT OR REPLACE INTO processed (content_key, doc_id) VALUES (?, ?)",
+        (key, doc_id))
+    _CACHE.commit()
+
+_SEM_INDEX = faiss.IndexFlatIP(EMBEDDING_DIM)
+_SEM_RESPONSES: list[str] = []
+for _emb, _resp in _CACHE.execute("SELECT embedding, response FROM semantic_cache ORDER BY id"):
+    _SEM_INDEX.add(np.frombuffer(_emb, dtype=np.float32).reshape(1, -1))
+    _SEM_RESPONSES.append(_resp)
+if _SEM_RESPONSES:
+    log(f"Loaded {len(_SEM_RESPONSES):,} cached responses from {CACHE_DB_PATH}")
+
+async def embed(text: str) -> np.ndarray:
+    r = await ACLIENT.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vec = np.asarray(r.data[0].embedding, dtype=np.float32)
+    # Normalize so inner product == cosine similarity
+    return vec / np.linalg.norm(vec)
+
+async def cached_ask(system_text: str, user_msg: str, name: str) -> str:
+    prompt_hash = hashlib.sha256(user_msg.encode("utf-8")).hexdigest()
+    row = _CACHE.execute(
+        "SELECT response FROM exact_cache WHERE prompt_hash = ?", (prompt_hash,)
+    ).fetchone()
+    if row:
+        log(f"Cache hit (exact) for {name}")
+        return row[0]
+
+    vec = await embed(user_msg)
+    if _SEM_INDEX.ntotal:
+        scores, ids = _SEM_INDEX.search(vec.reshape(1, -1), 1)
+        if scores[0][0] >= SEMANTIC_CACHE_THRESHOLD:
+            log(f"Cache hit (semantic, {scores[0][0]:.3f}) for {name}")
+            return _SEM_RESPONSES[ids[0][0]]
+
+    response = await ask_openai(system_text, user_msg, name)
+    _CACHE.execute(
+        "INSERT OR REPLACE INTO exact_cache (prompt_hash, response) VALUES (?, ?)",
+        (prompt_hash, response))
+    _CACHE.execute(
+        "INSERT INTO semantic_cache (embedding, response) VALUES (?, ?)",
+        (vec.tobytes(), response))
+    _CACHE.commit()
+    _SEM_INDEX.add(vec.reshape(1, -1))
+    _SEM_RESPONSES.append(response)
+    return response
 
 # ─────────────── ENFORCERS / NORMALIZERS ───────────────
+# Band thresholds as an indexable tuple: (score>=0.5) + (score>=1.0) picks
+# Low/Mid/High without branching, and nothing is redefined per call.
+_BANDS = ("Low", "Mid", "High")
+
 def normalize_afi(doc: dict):
     """Round afi_score and ensure afi_band matches thresholds."""
     try:
-        # Coerce afi_score to float and round to one decimal
-        score = float(doc.get("afi_score"))
-        score = round(score, 1)
-        doc["afi_score"] = score
-        # Determine band if missing or inconsistent
-        band = doc.get("afi_band", "")
-        def band_for(x: float) -> str:
-            if x >= 1.0: return "High"
-            if x >= 0.5: return "Mid"
-            return "Low"
-        correct_band = band_for(score)
-        if band not in ("High", "Mid", "Low") or band != correct_band:
-            doc["afi_band"] = correct_band
-    except Exception:
-        # If afi_score missing or invalid, leave as-is; add a soft warning
+        score = round(float(doc.get("afi_score")), 1)
+    except (TypeError, ValueError):
+        # afi_score missing or invalid: leave as-is, add a soft warning
         doc.setdefault("validation_warning", "afi_score_invalid")
+        return
+    doc["afi_score"] = score
+    correct_band = _BANDS[(score >= 0.5) + (score >= 1.0)]
+    if doc.get("afi_band") != correct_band:
+        doc["afi_band"] = correct_band
 
 def ensure_required_keys(doc: dict):
     """Make sure required keys from Prompt01 exist, even if null."""
@@ -240,16 +543,124 @@ def ensure_required_keys(doc: dict):
         doc.setdefault(k, None)
 
 # ─────────────── BULK PIPELINE ───────────────
+# One pooled session for all OpenSearch traffic: keeps the HTTPS connection
+# alive across flushes (saves the TCP + TLS handshake per batch) and retries
+# transient 429/5xx responses at the transport layer.
+SESSION = requests.Session()
+SESSION.auth = (OS_USERNAME, OS_PASSWORD)
+SESSION.headers.update({"Content-Type": "application/x-ndjson"})
+SESSION.verify = OS_CA_CERT if OS_CA_CERT else True
+# 429 is deliberately absent from the forcelist: bulk throttling is handled
+# by the application-level backoff in _post_chunk, which must see the status.
+# raise_on_status=False returns the last 5xx response after the transport
+# retries are exhausted instead of raising RetryError.
+_adapter = HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["POST", "PUT"],
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+# Chunking limits for a single bulk request, mirroring the opensearch-py
+# helpers.bulk defaults: cap both doc count and payload bytes so small docs
+# coalesce into few round-trips and large docs never produce an oversized
+# request the cluster rejects.
+OS_BULK_CHUNK_DOCS      = 500
+OS_BULK_MAX_CHUNK_BYTES = 100 * 1024 * 1024
+OS_BULK_MAX_RETRIES     = 3
+OS_BULK_INITIAL_BACKOFF = 2  # seconds, doubled per retry
+
+# Flush triggers: accumulate until either the payload is big enough for an
+# efficient bulk request or enough docs have piled up. Counting bytes rather
+# than lines means tiny docs coalesce instead of causing many small HTTP
+# requests, and huge docs flush early instead of ballooning the buffer.
+OS_BULK_MAX_BYTES = int(os.getenv("OS_BULK_MAX_BYTES", str(10 * 1024 * 1024)))
+OS_BULK_MAX_DOCS  = int(os.getenv("OS_BULK_MAX_DOCS", "500"))
+
+# Optional: stamp every doc in a buffered batch with one random routing value
+# so the whole batch lands on a single shard instead of fanning out through
+# the coordinator; mitigates slow-shard tail latency under sustained ingest.
+# Off by default: routing becomes part of doc placement, so reruns of the
+# same data with different routing can leave duplicates on other shards.
+OS_BULK_ROUTING = os.getenv("OS_BULK_ROUTING", "off").lower() in ("on", "1", "true")
+
 bulk = []
+bulk_bytes = 0
+# One (content_key, doc_id) entry per buffered doc, in buffer order; keys are
+# promoted to the processed table only after their chunk indexes cleanly.
+bulk_keys = []
+_bulk_route = None
+
+def bulk_full() -> bool:
+    return bulk_bytes >= OS_BULK_MAX_BYTES or len(bulk) >= 2 * OS_BULK_MAX_DOCS
+
+# Ingest-time index tuning. Default OpenSearch settings (refresh every 1s,
+# translog flush at 512mb) cause heavy segment churn while thousands of docs
+# stream in; relaxing them for the duration of the run and restoring after
+# cuts cluster CPU/IO. Disable with OS_TUNE_INDEX=off if the index serves
+# live queries during ingest.
+OS_TUNE_INDEX = os.getenv("OS_TUNE_INDEX", "on").lower() in ("on", "1", "true")
+
+def _index_base_url():
+    """Derive the index URL from OS_URL/OS_INDEX, or None if not derivable."""
+    if "/_bulk" not in OS_URL:
+        return None
+    base = OS_URL.rsplit("/_bulk", 1)[0]
+    return f"{base}/{OS_INDEX}" if OS_INDEX else base
+
+def tune_index(on: bool):
+    """Relax refresh/translog settings for bulk ingest (on) or restore (off)."""
+    base = _index_base_url()
+    if not OS_TUNE_INDEX or base is None:
+        return
+    settings = {"index": {
+        "refresh_interval": "30s" if on else "1s",
+        "translog.flush_threshold_size": "1gb" if on else "512mb",
+    }}
+    try:
+        r = SESSION.put(f"{base}/_settings", json=settings,
+                        headers={"Content-Type": "application/json"}, timeout=60)
+        if r.ok:
+            log(f"Index settings {'relaxed for ingest' if on else 'restored'}")
+        else:
+            log(f"Index settings update failed: {r.status_code} {r.text[:300]}")
+    except requests.RequestException as e:
+        log(f"Index settings update failed: {e}")
+
+def force_merge():
+    """Merge segments once after ingest so the index is read-optimal."""
+    base = _index_base_url()
+    if not OS_TUNE_INDEX or base is None:
+        return
+    try:
+        r = SESSION.post(f"{base}/_forcemerge?max_num_segments=1", timeout=600)
+        log(f"Force merge {'ok' if r.ok else f'failed: {r.status_code}'}")
+    except requests.RequestException as e:
+        log(f"Force merge failed: {e}")
+
+def doc_id_for(company: dict) -> str:
+    return ((company.get("company_name") or company.get("name") or "noid")
+            .replace(" ", "_").replace("/", "").lower())
+
+def add(company: dict, ai_json: str, key=None):
+    """Merge company facts with AI JSON and add to bulk payload.
 
-def add(company: dict, ai_json: str):
-    """Merge company facts with AI JSON and add to bulk payload."""
-    doc_id = ((company.get("company_name") or company.get("name") or "noid")
-              .replace(" ", "_").replace("/", "").lower())
+    `key` is the company's content_key; flush() marks it processed once the
+    doc's chunk has actually been indexed, so a failed chunk stays eligible
+    for the next run.
+    """
+    doc_id = doc_id_for(company)
 
     doc = dict(company)  # start with existing facts
     try:
-        ai_obj = json.loads(ai_json)
+        ai_obj = orjson.loads(ai_json)
         if not isinstance(ai_obj, dict):
             raise ValueError("AI response was not a JSON object")
         doc.update(ai_obj)
@@ -261,47 +672,274 @@ def add(company: dict, ai_json: str):
     ensure_required_keys(doc)
     normalize_afi(doc)
 
-    # Add to NDJSON bulk body
+    # Add to NDJSON bulk body (orjson emits UTF-8 bytes directly, no
+    # re-encoding pass in flush; non-ASCII passes through unescaped)
+    global bulk_bytes, _bulk_route
     action_meta = {"_id": doc_id}
     if OS_INDEX:
         action_meta["_index"] = OS_INDEX
-    bulk.extend([
-        json.dumps({"index": action_meta}),
-        json.dumps(doc, ensure_ascii=False)
-    ])
+    if OS_BULK_ROUTING:
+        if not bulk:  # fresh buffer → fresh route
+            _bulk_route = secrets.token_hex(4)
+        action_meta["routing"] = _bulk_route
+    action_line = orjson.dumps({"index": action_meta})
+    doc_line = orjson.dumps(doc)
+    bulk.extend([action_line, doc_line])
+    bulk_keys.append((key, doc_id))
+    bulk_bytes += len(action_line) + len(doc_line) + 2
+
+def _chunk_actions(lines: list):
+    """Split buffered action/document byte-line pairs into bounded chunks."""
+    chunk, size = [], 0
+    for action, doc in zip(lines[::2], lines[1::2]):
+        n = len(action) + len(doc) + 2  # two newline separators
+        if chunk and (len(chunk) // 2 >= OS_BULK_CHUNK_DOCS
+                      or size + n > OS_BULK_MAX_CHUNK_BYTES):
+            yield chunk
+            chunk, size = [], 0
+        chunk.extend((action, doc))
+        size += n
+    if chunk:
+        yield chunk
+
+def _post_chunk(chunk: list) -> bool:
+    """POST one bulk chunk, retrying throttled (429) responses with backoff.
+
+    Index ops are idempotent (same _id overwrites), so resending a whole
+    chunk after a partial 429 is safe. Returns True once the chunk was
+    indexed cleanly, False if it was given up on.
+    """
+    body = b"\n".join(chunk) + b"\n"
+    # NDJSON of dense JSON docs compresses 5-10x; level 1 keeps CPU cost
+    # negligible while still removing most of the bytes on the wire.
+    payload = gzip.compress(body, compresslevel=1)
+    backoff = OS_BULK_INITIAL_BACKOFF
+    for attempt in range(OS_BULK_MAX_RETRIES + 1):
+        try:
+            r = SESSION.post(OS_URL, data=payload,
+                             headers={"Content-Encoding": "gzip"}, timeout=180)
+        except requests.RequestException as e:
+            if attempt < OS_BULK_MAX_RETRIES:
+                log(f"Bulk request failed ({e}); retrying in {backoff}s")
+                time.sleep(backoff)
+                backoff *= 2
+                continue
+            log(f"OpenSearch bulk error: {e}")
+            return False
+        if r.ok and '"errors":true' not in r.text:
+            log(f"Bulk ok – {len(chunk)//2} docs")
+            return True
+        throttled = r.status_code == 429 or (r.ok and '"status":429' in r.text)
+        if throttled and attempt < OS_BULK_MAX_RETRIES:
+            log(f"Bulk throttled; retrying in {backoff}s (attempt {attempt + 1})")
+            time.sleep(backoff)
+            backoff *= 2
+            continue
+        log(f"OpenSearch bulk error: {r.status_code} {r.text[:600]}")
+        return False
+    return False
 
 def flush():
+    global bulk_bytes
     if not bulk:
         return
-    body = "\n".join(bulk) + "\n"
     try:
-        r = requests.post(
-            OS_URL,
-            headers={"Content-Type": "application/x-ndjson"},
-            data=body.encode("utf-8"),
-            auth=(OS_USERNAME, OS_PASSWORD),
-            verify=OS_CA_CERT if OS_CA_CERT else True,
-            timeout=180,
-        )
-        if not r.ok or '"errors":true' in r.text:
-            log(f"OpenSearch bulk error: {r.status_code} {r.text[:600]}")
-        else:
-            log(f"Bulk ok – {len(bulk)//2} docs")
+        done = 0
+        for chunk in _chunk_actions(bulk):
+            ok = _post_chunk(chunk)
+            ndocs = len(chunk) // 2
+            if ok:
+                # Docs are durably indexed only now; promote their keys so
+                # reruns skip them. Failed chunks stay unmarked and get
+                # re-enriched (or served from cache) on the next run.
+                for key, doc_id in bulk_keys[done:done + ndocs]:
+                    if key:
+                        mark_processed(key, doc_id)
+            done += ndocs
     finally:
         bulk.clear()
+        bulk_keys.clear()
+        bulk_bytes = 0
 
 # ─────────────── MAIN LOOP ───────────────
-for idx, company in enumerate(tqdm(companies, desc="Collecting Prompt01 fields")):
+# `add()` stays synchronous; BULK_LOCK serializes buffer access across tasks
+# so the NDJSON action/document line pairs are never interleaved.
+BULK_LOCK = asyncio.Lock()
+
+async def process(company: dict, idx: int):
     name = company.get("company_name", f"idx_{idx}")
     try:
-        user_msg = render_placeholders(USER_TEMPLATE, company)
-        ai_json = ask_openai(SYSTEM_TEXT, user_msg, name)
-        add(company, ai_json)
-        # Flush roughly every 50 docs (100 lines): keep payloads modest
-        if len(bulk) >= 100:
-            flush()
+        key = content_key(company)
+        if already_processed(key):
+            log(f"Skipping {name}: already processed", also_print=False)
+            return
+        user_msg = render_user_msg(company)
+        ai_json = await cached_ask(SYSTEM_TEXT, user_msg, name)
+        async with BULK_LOCK:
+            add(company, ai_json, key=key)
+            if bulk_full():
+                await asyncio.to_thread(flush)
     except Exception as e:
         log(f"⚠️ {name}: {e}")
 
-flush()
-log("===== Script Finished =====")
+async def run_sync(companies: Iterable[dict], total: int, position: int = 0):
+    """Real-time path: concurrent chat completions, indexed as they arrive.
+
+    A fixed pool of OPENAI_CONCURRENCY workers pulls from the (possibly
+    streaming) company iterator, so only that many records plus their tasks
+    are ever resident at once. Pulling via next() is safe without a lock:
+    the event loop is single-threaded and there is no await between pulls.
+    """
+    it = enumerate(companies)
+    pbar = tqdm_asyncio(total=total, desc="Collecting Prompt01 fields",
+                        position=position)
+
+    async def worker():
+        while True:
+            try:
+                idx, company = next(it)
+            except StopIteration:
+                return
+            await process(company, idx)
+            pbar.update(1)
+
+    await asyncio.gather(*(worker() for _ in range(OPENAI_CONCURRENCY)))
+    pbar.close()
+    flush()
+
+def run_shard(shard: int, nshards: int, total: int):
+    """Sync-mode entry point for one worker process.
+
+    Under the spawn start method the module re-imports, so each process gets
+    its own OpenSearch session, OpenAI client, bulk buffer, and cache
+    connection. Every shard re-streams the input file with a stride of
+    nshards, keeping memory at O(concurrency) per process.
+    """
+    companies = itertools.islice(iter_companies(MEMBER_JSON_PATH), shard, None, nshards)
+    shard_total = (total - shard + nshards - 1) // nshards
+    asyncio.run(run_sync(companies, total=shard_total, position=shard))
+
+# ─────────────── BATCH PIPELINE ───────────────
+def build_batch_jsonl(companies: Iterable[dict], path: str) -> dict:
+    """Write one Batch API request line per company; return custom_id→company."""
+    by_id = {}
+    skipped = 0
+    with open(path, "wb") as fh:
+        for idx, company in enumerate(companies):
+            if already_processed(content_key(company)):
+                skipped += 1
+                continue
+            doc_id = doc_id_for(company)
+            if doc_id in by_id:
+                # custom_ids must be unique per batch; keep the first
+                # occurrence so a name collision can't fail the submission
+                log(f"Duplicate doc_id {doc_id}; keeping first occurrence")
+                continue
+            by_id[doc_id] = company
+            user_msg = render_user_msg(company)
+            fh.write(orjson.dumps({
+                "custom_id": doc_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": OPENAI_MODEL,
+                    "messages": build_messages(SYSTEM_TEXT, user_msg),
+                    "response_format": {"type": "json_object"},
+                    "temperature": 0.2,
+                },
+            }) + b"\n")
+    if skipped:
+        log(f"Skipped {skipped:,} already-processed companies")
+    return by_id
+
+def run_batch(companies: Iterable[dict]):
+    """Batch path: one JSONL submission, 24h completion window, ~50% cost.
+
+    No per-request rate limits apply, so the RPM/TPM limiters are bypassed
+    entirely; this is the right mode for full directory runs.
+    """
+    batch_path = os.path.join(LOG_DIR, f"batch_{datetime.now():%Y%m%d_%H%M%S}.jsonl")
+    by_id = build_batch_jsonl(companies, batch_path)
+    if not by_id:
+        log("Nothing to do: every company is already processed")
+        return
+    log(f"Wrote {len(by_id):,} batch requests to {batch_path}")
+
+    with open(batch_path, "rb") as fh:
+        batch_file = CLIENT.files.create(file=fh, purpose="batch")
+    batch = CLIENT.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    log(f"Submitted batch {batch.id}; polling every {BATCH_POLL_SECONDS}s")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = CLIENT.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        log(f"Batch {batch.id}: {batch.status} "
+            f"({counts.completed}/{counts.total}, {counts.failed} failed)")
+    if batch.status != "completed":
+        raise SystemExit(f"Batch {batch.id} ended with status: {batch.status}")
+
+    failed = 0
+    for line in CLIENT.files.content(batch.output_file_id).iter_lines():
+        if not line.strip():
+            continue
+        rec = orjson.loads(line)
+        doc_id = rec.get("custom_id", "")
+        response = rec.get("response") or {}
+        if rec.get("error") or response.get("status_code") != 200:
+            log(f"Batch item failed for {doc_id}: {rec.get('error') or response.get('status_code')}")
+            failed += 1
+            continue
+        ai_json = response["body"]["choices"][0]["message"]["content"]
+        company = by_id.get(doc_id, {})
+        add(company, ai_json, key=content_key(company))
+        if bulk_full():
+            flush()
+    flush()
+    if failed:
+        log(f"Batch {batch.id}: {failed} items failed; see error file {batch.error_file_id}")
+
+# ─────────────── ENTRY POINT ───────────────
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Enrich company records via OpenAI and index into OpenSearch")
+    p.add_argument(
+        "--mode", choices=("batch", "sync"), default="batch",
+        help="batch: submit one Batch API job (24h SLA, ~50%% cheaper, no rate limits); "
+             "sync: concurrent real-time completions for small runs (default: batch)",
+    )
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        total = count_companies(MEMBER_JSON_PATH)
+    except Exception as e:
+        raise SystemExit(f"Cannot load companies: {e}")
+    log(f"Counted {total:,} companies in {MEMBER_JSON_PATH}")
+
+    tune_index(True)
+    try:
+        if args.mode == "sync":
+            workers = max(1, min(WORKERS, total))
+            if workers > 1:
+                # Children inherit these: one shared logfile, and per-process
+                # rate ceilings divided so the shards jointly respect the
+                # account's RPM/TPM limits.
+                os.environ["CHAMBER_LOGFILE"] = logfile
+                os.environ["OPENAI_RPM"] = str(max(1, OPENAI_RPM // workers))
+                os.environ["OPENAI_TPM"] = str(max(1, OPENAI_TPM // workers))
+                log(f"Sharding across {workers} worker processes")
+                with mp.get_context("spawn").Pool(processes=workers) as pool:
+                    pool.starmap(run_shard, [(i, workers, total) for i in range(workers)])
+            else:
+                asyncio.run(run_sync(iter_companies(MEMBER_JSON_PATH), total))
+        else:
+            run_batch(iter_companies(MEMBER_JSON_PATH))
+    finally:
+        tune_index(False)
+        force_merge()
+    log("===== Script Finished =====")